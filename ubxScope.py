@@ -3,14 +3,22 @@
 import ubx
 from ubx import parseUBXMessage, UBXManager
 from pathlib import Path
-from queue import Queue
 from functools import partial
 
+import os
 import sys
+import threading
 import numpy as np
 import argparse
 import csv
 
+# Numba is optional: when present the per-message spectrum maths is
+# compiled to a single fused pass, otherwise NumPy ufuncs are used
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 from bokeh.io import curdoc
 from bokeh.layouts import column, row
 from bokeh.plotting import figure
@@ -22,9 +30,26 @@ TOOLTIPS = [
 
 TOOLS = "pan,wheel_zoom,box_zoom,reset,save,tap"
 
+# Plot rendering backend. WebGL's per-frame buffer upload overhead is
+# only amortised for far larger glyph counts than three 256-point lines
+# per figure, so default to Canvas; set UBXSCOPE_OUTPUT_BACKEND=webgl
+# to switch back
+OUTPUT_BACKEND = os.environ.get('UBXSCOPE_OUTPUT_BACKEND', 'canvas')
+
+# Trace colours per RF block on the shared figure
+TRACE_COLOURS = [
+    {'spectrum': 'blue', 'max': 'red', 'avg': 'green'},
+    {'spectrum': 'teal', 'max': 'orangered', 'avg': 'limegreen'},
+]
+
 # Averaging Window Length
 TIME_AVERAGING_WINDOW_LENGTH = 10  # data frames (i.e defined by epoch rate)
 
+# Peak-hold Window Length
+# The max trace holds the peak over the last N frames rather than
+# forever, so transient interference eventually decays off the display
+MAX_HOLD_WINDOW_LENGTH = 64  # data frames
+
 # Bin Width
 # This is defined in SPAN but for convenience of plotting setup
 # it is hard coded here
@@ -94,15 +119,108 @@ QZSS_L2_CM_CL_FC = X2_FC  # L2 CM, CL
 QZSS_L5_I_Q_FC = X5A_FC  # L5 I,Q
 QZSS_E6_LEX_FC = X6_FC  # E6 LEX
 
+# Band annotation table: (label, centre frequency, colour, label row, bold)
+# One shared set of Span/Label models is built from this and reused on
+# every figure, rather than constructing duplicates per block
+BAND_ANNOTATIONS = [
+    # GPS
+    ('GPS L1', GPS_L1_CA_P_C_M_FC, 'orange', 0, True),
+    ('GPS L2', GPS_L2_P_CM_CL_M_FC, 'orange', 0, True),
+    ('GPS L5', GPS_L5_I_Q_FC, 'orange', 0, False),
+    # Galileo
+    ('GAL E1', GALILEO_E1_I_Q_FC, 'green', 1, True),
+    ('GAL E5b', GALILEO_E5A_I_Q_FC, 'green', 1, False),
+    ('GAL E5a', GALILEO_E5B_I_Q_FC, 'green', 1, True),
+    ('GAL E5 ALTBOC', GALILEO_E5_ALTBOC_FC, 'green', 1, False),
+    ('GAL E6', GALILEO_E6_I_Q_PRS_FC, 'green', 1, False),
+    # Glonass CDMA
+    ('GLO L1 CDMA', GLONASS_L1_OC_SC_FC, 'purple', 1, False),
+    ('GLO L2 CDMA', GLONASS_L2_OC_SC_FC, 'purple', 1, False),
+    ('GLO L3 CDMA', GLONASS_L3_OC_SC_FC, 'purple', 0, False),
+    # QZSS
+    ('QZSS L1', QZSS_L1_CA_C_SAIF_FC, 'yellow', 4, True),
+    ('QZSS L2', QZSS_L2_CM_CL_FC, 'yellow', 4, True),
+    ('QZSS L5', QZSS_L5_I_Q_FC, 'yellow', 4, False),
+    ('QZSS E6 LEX', QZSS_E6_LEX_FC, 'yellow', 4, False),
+    # Beidou
+    ('BDS B1 I/Q', BEIDOU_B1_I_Q_FC, 'red', 3, True),
+    ('BDS B1 C/a', BEIDOU_B1_C_A_FC, 'red', 3, False),
+    ('BDS B2 a', BEIDOU_B2_A_FC, 'red', 3, False),
+    ('BDS B2 I/Q/b', BEIDOU_B2_I_Q_B_FC, 'red', 3, True),
+    ('BDS B3 I/Q/A', BEIDOU_B3_I_Q_A_FC, 'red', 3, False),
+]
+
 # Be quiet on errors.
 
 
+def buildFrequencyAnnotations():
+    annotations = []
+    for label, fc, colour, labelRow, bold in BAND_ANNOTATIONS:
+        annotations.append(Span(location=fc, dimension='height',
+                                line_color=colour, line_dash='dashed', line_width=0.5))
+        annotations.append(Label(text=label, x=fc, y=YMIN_LABEL+(labelRow*LABEL_YSPACE),
+                                 text_font_size='9px', text_align='center',
+                                 text_font_style='bold' if bold else 'normal'))
+
+    # GLONASS FDMA L1OF & L2OF Carriers
+    # Compute the carrier centre frequencies in one vectorised pass
+    carriers = np.arange(-7, 9)
+    gloL1OFf0 = GLONASS_L1_OF_SF_FC + (carriers * GLONASS_L1_OF_SF_SPACING)
+    gloL2OFf0 = GLONASS_L2_OF_SF_FC + (carriers * GLONASS_L2_OF_SF_SPACING)
+    annotations.extend(Span(location=int(f0), dimension='height', line_color='purple',
+                            line_dash='dashed', line_width=0.2)
+                       for f0 in np.concatenate([gloL1OFf0, gloL2OFf0]))
+
+    # GLONASS FDMA labels
+    annotations.append(Label(text='GLO L1 FDMA', x=GLONASS_L1_OF_SF_FC,
+                             y=YMIN_LABEL, text_font_size='9px', text_align='center', text_font_style='bold'))
+    annotations.append(Label(text='GLO L2 FDMA', x=GLONASS_L2_OF_SF_FC,
+                             y=YMIN_LABEL, text_font_size='9px', text_align='center', text_font_style='bold'))
+
+    return annotations
+
+
+# Fused per-bin update of the peak-hold and moving-average ring buffers:
+# one pass over the 256 bins instead of one per ufunc.
+# The kernel runs on the UBX reader thread; nogil lets the Bokeh IOLoop
+# take the GIL and flush websocket frames while it runs.
+# spectrum is the newly received PSD, maxRow and avgRow the peak-hold
+# and averaging ring rows being replaced, avgSum the running
+# column-wise sum, and avgOut the displayed average for the current
+# fill level. The peak-hold reduction over its ring happens separately.
+# The explicit signature makes Numba compile at import time, so the
+# first SPAN message doesn't pay the JIT stall; all array arguments are
+# contiguous float32 rows and filled is a plain int
+if njit is not None:
+    @njit('void(float32[::1], float32[::1], float32[::1], float32[::1], float32[::1], int64)',
+          cache=True, nogil=True, fastmath=True)
+    def fuseSpectrumUpdate(spectrum, maxRow, avgRow, avgSum, avgOut, filled):
+        for i in range(spectrum.shape[0]):
+            s = spectrum[i]
+            maxRow[i] = s
+            avgSum[i] += s - avgRow[i]
+            avgRow[i] = s
+            avgOut[i] = avgSum[i] / filled
+else:
+    def fuseSpectrumUpdate(spectrum, maxRow, avgRow, avgSum, avgOut, filled):
+        maxRow[:] = spectrum
+        np.subtract(avgSum, avgRow, out=avgSum)
+        np.add(avgSum, spectrum, out=avgSum)
+        avgRow[:] = spectrum
+        np.divide(avgSum, filled, out=avgOut)
+
+
 class UBXScopeQueue(UBXManager):
     def __init__(self, ser, debug=False, eofTimeout=None, onUBXCallback=None):
-        self._queue = Queue()
-        # Reflects the has-a queue's get() and empty() methods
-        self.empty = self._queue.empty
         self.onUBXCallback = onUBXCallback
+        # Concrete classes of the handled message types, resolved from the
+        # first instance of each seen, so the per-message dispatch is an
+        # identity compare rather than a name build plus list scan
+        self.spanMsgType = None
+        self.pvtMsgType = None
+        # Types already resolved as unhandled, so their class-name string
+        # is only ever built once
+        self.ignoredMsgTypes = set()
 
         super(UBXScopeQueue, self).__init__(
             ser=ser, debug=debug, eofTimeout=eofTimeout)
@@ -117,10 +235,23 @@ class UBXScopeQueue(UBXManager):
         return
 
     def onUBX(self, msg):
-        if msg.__class__.__name__ in ['SPAN', 'PVT']:
-            self.onUBXCallback(msg, msg.__class__.__name__)
-        # else:
-            # print(f'Unhandled: {msg.__class__.__name__}')
+        msgType = type(msg)
+        if msgType is self.spanMsgType:
+            self.onUBXCallback(msg, 'SPAN')
+        elif msgType is self.pvtMsgType:
+            self.onUBXCallback(msg, 'PVT')
+        elif msgType not in self.ignoredMsgTypes:
+            # First sighting of this message type: resolve by name once
+            msgName = msgType.__name__
+            if msgName == 'SPAN':
+                self.spanMsgType = msgType
+                self.onUBXCallback(msg, 'SPAN')
+            elif msgName == 'PVT':
+                self.pvtMsgType = msgType
+                self.onUBXCallback(msg, 'PVT')
+            else:
+                self.ignoredMsgTypes.add(msgType)
+                # print(f'Unhandled: {msgName}')
 
 
 class UBXScope:
@@ -128,8 +259,8 @@ class UBXScope:
         self.numRfBlocks = 2
 
         # Metadata stores
-        # Per block
-        self.spectrumMetadata = [{'pga': 0, }
+        # Per block, preallocated and updated in place per SPAN message
+        self.spectrumMetadata = [{'pgaGain': 0, }
                                  for block in range(self.numRfBlocks)]
         # Global
         self.ubxMetadata = {'timeUTC': ""}
@@ -142,31 +273,87 @@ class UBXScope:
         self.doc = curdoc()
         self.doc.title = "UBX Scope"
 
+        # Preallocated per-block plot buffers, written in place on each SPAN
+        # message and shared with the plot update callback
+        self.spectrumPlotBuffers = [{
+            'spectrumBinCenterFreqs': np.zeros(SPAN_BIN_COUNT),
+            'spectrumMax': np.zeros(SPAN_BIN_COUNT, dtype=np.float32),
+            'spectrumAvg': np.zeros(SPAN_BIN_COUNT, dtype=np.float32),
+            'spectrum': np.zeros(SPAN_BIN_COUNT, dtype=np.float32)
+        } for block in range(self.numRfBlocks)]
+
+        # Steady-state patch payloads referencing the plot buffers, built
+        # once so no per-frame dict or slice tuples are allocated
+        self.spectrumPatchData = [{
+            'spectrum': [(slice(SPAN_BIN_COUNT), plotBuffers['spectrum'])],
+            'spectrumMax': [(slice(SPAN_BIN_COUNT), plotBuffers['spectrumMax'])],
+            'spectrumAvg': [(slice(SPAN_BIN_COUNT), plotBuffers['spectrumAvg'])]
+        } for plotBuffers in self.spectrumPlotBuffers]
+
+        # Coalesce SPAN updates: the plot buffers always hold the latest
+        # frame, so at most one plot update needs to be queued per tick
+        # regardless of the SPAN arrival rate
+        self.spectrumUpdateLock = threading.Lock()
+        self.spectrumUpdateScheduled = False
+
+        # The bin centre frequencies are static after the first SPAN
+        # message, so they are only sent to the browser once
+        self.spectrumFreqsSent = [False for block in range(self.numRfBlocks)]
+
         # Per-block arrays
-        self.spectrumFigures = [self.numRfBlocks, None]
-        self.blockMetadataLabels = [self.numRfBlocks, None]
-        self.blockColumnLayouts = [self.numRfBlocks, None]
-        self.spectrumAvgBuffers = [self.numRfBlocks, None]
-        self.spectrumDataSources = [self.numRfBlocks, None]
-        self.selectionLabels = [self.numRfBlocks, None]
-        self.selectionMarkers = [self.numRfBlocks, None]
-        self.selectionLabelData = [self.numRfBlocks, None]
-        # Add a figure for each block
+        self.blockMetadataLabels = [None] * self.numRfBlocks
+        self.spectrumAvgBuffers = [None] * self.numRfBlocks
+        self.spectrumMaxBuffers = [None] * self.numRfBlocks
+        self.spectrumDataSources = [None] * self.numRfBlocks
+        self.selectionLabels = [None] * self.numRfBlocks
+        self.selectionMarkers = [None] * self.numRfBlocks
+        self.selectionLabelData = [None] * self.numRfBlocks
+        # Frequency annotations
+        frequencyAnnotations = buildFrequencyAnnotations()
+
+        # One shared figure for all RF blocks: the blocks cover disjoint
+        # frequency ranges, so drawing them on a single pair of axes
+        # halves the BokehJS renderer, legend, and event-dispatch work
+        self.spectrumFigure = figure(title="UBX SPAN",
+                                     output_backend=OUTPUT_BACKEND,
+                                     y_range=(YMIN, YMAX),
+                                     tooltips=TOOLTIPS,
+                                     tools=TOOLS,
+                                     plot_width=PLOT_WIDTH,
+                                     plot_height=PLOT_HEIGHT)
+
+        # Label Axes
+        self.spectrumFigure.xaxis.axis_label = "Frequency (Hz)"
+        self.spectrumFigure.yaxis.axis_label = "Received Power dB (Unref)"
+
+        # Centre Frequencies
+        self.spectrumFigure.renderers.extend(frequencyAnnotations)
+
+        legendItems = []
+
+        # Add the traces for each block
         for block in range(self.numRfBlocks):
 
-            # One Data Source for each figure, shared per-plot
+            # One Data Source for each block, shared by its traces
             self.spectrumDataSources[block] = ColumnDataSource(data={
                 'spectrumBinCenterFreqs': np.zeros(SPAN_BIN_COUNT),
-                'spectrumMax': np.zeros(SPAN_BIN_COUNT),
-                'spectrumAvg': np.zeros(SPAN_BIN_COUNT),
-                'spectrum': np.zeros(SPAN_BIN_COUNT)
+                'spectrumMax': np.zeros(SPAN_BIN_COUNT, dtype=np.float32),
+                'spectrumAvg': np.zeros(SPAN_BIN_COUNT, dtype=np.float32),
+                'spectrum': np.zeros(SPAN_BIN_COUNT, dtype=np.float32)
             })
 
+            # Peak-hold Buffer
+            self.spectrumMaxBuffers[block] = {
+                'buffer': np.full((MAX_HOLD_WINDOW_LENGTH, SPAN_BIN_COUNT), -np.inf, dtype=np.float32),
+                'index': 0  # Use the ndarray as a circular buffer
+            }
+
             # Moving Average Buffer
             self.spectrumAvgBuffers[block] = {
-                'buffer': np.zeros((TIME_AVERAGING_WINDOW_LENGTH, SPAN_BIN_COUNT)),
+                'buffer': np.zeros((TIME_AVERAGING_WINDOW_LENGTH, SPAN_BIN_COUNT), dtype=np.float32),
                 'index': 0,  # Use the ndarray as a circular buffer
-                'filled': 1  # Buffer fullness
+                'filled': 1,  # Buffer fullness
+                'sum': np.zeros(SPAN_BIN_COUNT, dtype=np.float32)  # Running column-wise sum of the buffer
             }
 
             self.selectionLabelData[block] = {
@@ -177,34 +364,27 @@ class UBXScope:
                 'power': 0
             }
 
-            figure_ = figure(title=f"UBX SPAN Block {block+1}",
-                             output_backend="webgl",
-                             y_range=(YMIN, YMAX),
-                             tooltips=TOOLTIPS,
-                             tools=TOOLS,
-                             plot_width=PLOT_WIDTH,
-                             plot_height=PLOT_HEIGHT)
-
             # Add instantaneous, avg, and max line plots
-            spectrum = figure_.line(source=self.spectrumDataSources[block],
-                                    x='spectrumBinCenterFreqs',
-                                    y='spectrum',
-                                    line_width=1,
-                                    line_color='blue'
-                                    )
-
-            spectrumMax = figure_.line(source=self.spectrumDataSources[block],
-                                       x='spectrumBinCenterFreqs',
-                                       y='spectrumMax',
-                                       line_width=1,
-                                       line_color='red'
-                                       )
-            spectrumAvg = figure_.line(source=self.spectrumDataSources[block],
-                                       x='spectrumBinCenterFreqs',
-                                       y='spectrumAvg',
-                                       line_width=1,
-                                       line_color='green'
-                                       )
+            colours = TRACE_COLOURS[block % len(TRACE_COLOURS)]
+            spectrum = self.spectrumFigure.line(source=self.spectrumDataSources[block],
+                                                x='spectrumBinCenterFreqs',
+                                                y='spectrum',
+                                                line_width=1,
+                                                line_color=colours['spectrum']
+                                                )
+
+            spectrumMax = self.spectrumFigure.line(source=self.spectrumDataSources[block],
+                                                   x='spectrumBinCenterFreqs',
+                                                   y='spectrumMax',
+                                                   line_width=1,
+                                                   line_color=colours['max']
+                                                   )
+            spectrumAvg = self.spectrumFigure.line(source=self.spectrumDataSources[block],
+                                                   x='spectrumBinCenterFreqs',
+                                                   y='spectrumAvg',
+                                                   line_width=1,
+                                                   line_color=colours['avg']
+                                                   )
 
             #spectrum.data_source.on_change('selected', self.selectCallback)
             #spectrum.on_change('line_indices', self.selectCallback)
@@ -217,168 +397,42 @@ class UBXScope:
             spectrumMax.on_change('visible', partial(
                 self.maxVisibleChangeHandler, block=block))
 
-            # Label Axes
-            figure_.xaxis.axis_label = "Frequency (Hz)"
-            figure_.yaxis.axis_label = "Received Power dB (Unref)"
-
-            # Legend
-            legend = Legend(items=[
-                ("PSD", [spectrum]),
-                ("Max PSD", [spectrumMax]),
-                ("Avg PSD", [spectrumAvg]),
-            ], location="center",
-                click_policy="hide")
-            figure_.add_layout(legend, 'left')
-
-            self.spectrumFigures[block] = figure_
-
-            # Centre Frequencies
-            # GPS
-            freqAnnotationsGPS = [
-                Span(location=GPS_L1_CA_P_C_M_FC, dimension='height',
-                     line_color='orange', line_dash='dashed', line_width=0.5),
-                Label(text='GPS L1', x=GPS_L1_CA_P_C_M_FC, y=YMIN_LABEL,
-                      text_font_size='9px', text_align='center', text_font_style='bold'),
-                Span(location=GPS_L2_P_CM_CL_M_FC, dimension='height',
-                     line_color='orange', line_dash='dashed', line_width=0.5),
-                Label(text='GPS L2', x=GPS_L2_P_CM_CL_M_FC, y=YMIN_LABEL,
-                      text_font_size='9px', text_align='center', text_font_style='bold'),
-                Span(location=GPS_L5_I_Q_FC, dimension='height',
-                     line_color='orange', line_dash='dashed', line_width=0.5),
-                Label(text='GPS L5', x=GPS_L5_I_Q_FC, y=YMIN_LABEL,
-                      text_font_size='9px', text_align='center')
-            ]
-
-            freqAnnotationsGalileo = [
-                Span(location=GALILEO_E1_I_Q_FC, dimension='height',
-                     line_color='green', line_dash='dashed', line_width=0.5),
-                Label(text='GAL E1', x=GALILEO_E1_I_Q_FC, y=YMIN_LABEL+LABEL_YSPACE,
-                      text_font_size='9px', text_align='center', text_font_style='bold'),
-                Span(location=GALILEO_E5A_I_Q_FC, dimension='height',
-                     line_color='green', line_dash='dashed', line_width=0.5),
-                Label(text='GAL E5b', x=GALILEO_E5A_I_Q_FC, y=YMIN_LABEL +
-                      LABEL_YSPACE, text_font_size='9px', text_align='center'),
-                Span(location=GALILEO_E5B_I_Q_FC, dimension='height',
-                     line_color='green', line_dash='dashed', line_width=0.5),
-                Label(text='GAL E5a', x=GALILEO_E5B_I_Q_FC, y=YMIN_LABEL+LABEL_YSPACE,
-                      text_font_size='9px', text_align='center', text_font_style='bold'),
-                Span(location=GALILEO_E5_ALTBOC_FC, dimension='height',
-                     line_color='green', line_dash='dashed', line_width=0.5),
-                Label(text='GAL E5 ALTBOC', x=GALILEO_E5_ALTBOC_FC, y=YMIN_LABEL +
-                      LABEL_YSPACE, text_font_size='9px', text_align='center'),
-                Span(location=GALILEO_E6_I_Q_PRS_FC, dimension='height',
-                     line_color='green', line_dash='dashed', line_width=0.5),
-                Label(text='GAL E6', x=GALILEO_E6_I_Q_PRS_FC, y=YMIN_LABEL +
-                      LABEL_YSPACE, text_font_size='9px', text_align='center')
-            ]
-
-            # Beidou
-            freqAnnotationsBeidou = [
-                Span(location=BEIDOU_B1_I_Q_FC, dimension='height',
-                     line_color='red', line_dash='dashed', line_width=0.5),
-                Label(text='BDS B1 I/Q', x=BEIDOU_B1_I_Q_FC, y=YMIN_LABEL+(3*LABEL_YSPACE),
-                      text_font_size='9px', text_align='center', text_font_style='bold'),
-                Span(location=BEIDOU_B1_C_A_FC, dimension='height',
-                     line_color='red', line_dash='dashed', line_width=0.5),
-                Label(text='BDS B1 C/a', x=BEIDOU_B1_C_A_FC, y=YMIN_LABEL +
-                      (3*LABEL_YSPACE), text_font_size='9px', text_align='center'),
-                Span(location=BEIDOU_B2_A_FC, dimension='height',
-                     line_color='red', line_dash='dashed', line_width=0.5),
-                Label(text='BDS B2 a', x=BEIDOU_B2_A_FC, y=YMIN_LABEL +
-                      (3*LABEL_YSPACE), text_font_size='9px', text_align='center'),
-                Span(location=BEIDOU_B2_I_Q_B_FC, dimension='height',
-                     line_color='red', line_dash='dashed', line_width=0.5),
-                Label(text='BDS B2 I/Q/b', x=BEIDOU_B2_I_Q_B_FC, y=YMIN_LABEL+(3*LABEL_YSPACE),
-                      text_font_size='9px', text_align='center', text_font_style='bold'),
-                Span(location=BEIDOU_B3_I_Q_A_FC, dimension='height',
-                     line_color='red', line_dash='dashed', line_width=0.5),
-                Label(text='BDS B3 I/Q/A', x=BEIDOU_B3_I_Q_A_FC, y=YMIN_LABEL +
-                      (3*LABEL_YSPACE), text_font_size='9px', text_align='center'),
-            ]
-
-            freqAnnotationsQZSS = [
-                Span(location=QZSS_L1_CA_C_SAIF_FC, dimension='height',
-                     line_color='yellow', line_dash='dashed', line_width=0.5),
-                Label(text='QZSS L1', x=QZSS_L1_CA_C_SAIF_FC, y=YMIN_LABEL+(4*LABEL_YSPACE),
-                      text_font_size='9px', text_align='center', text_font_style='bold'),
-                Span(location=QZSS_L2_CM_CL_FC, dimension='height',
-                     line_color='yellow', line_dash='dashed', line_width=0.5),
-                Label(text='QZSS L2', x=QZSS_L2_CM_CL_FC, y=YMIN_LABEL+(4*LABEL_YSPACE),
-                      text_font_size='9px', text_align='center', text_font_style='bold'),
-                Span(location=QZSS_L5_I_Q_FC, dimension='height',
-                     line_color='yellow', line_dash='dashed', line_width=0.5),
-                Label(text='QZSS L5', x=QZSS_L5_I_Q_FC, y=YMIN_LABEL +
-                      (4*LABEL_YSPACE), text_font_size='9px', text_align='center'),
-                Span(location=QZSS_E6_LEX_FC, dimension='height',
-                     line_color='yellow', line_dash='dashed', line_width=0.5),
-                Label(text='QZSS E6 LEX', x=QZSS_E6_LEX_FC, y=YMIN_LABEL +
-                      (4*LABEL_YSPACE), text_font_size='9px', text_align='center')
-            ]
-
-            freqAnnotationsGlonass = [
-                Span(location=GLONASS_L1_OC_SC_FC, dimension='height',
-                     line_color='purple', line_dash='dashed', line_width=0.5),
-                Label(text='GLO L1 CDMA', x=GLONASS_L1_OC_SC_FC, y=YMIN_LABEL +
-                      LABEL_YSPACE, text_font_size='9px', text_align='center'),
-                Span(location=GLONASS_L2_OC_SC_FC, dimension='height',
-                     line_color='purple', line_dash='dashed', line_width=0.5),
-                Label(text='GLO L2 CDMA', x=GLONASS_L2_OC_SC_FC, y=YMIN_LABEL +
-                      LABEL_YSPACE, text_font_size='9px', text_align='center'),
-                Span(location=GLONASS_L3_OC_SC_FC, dimension='height',
-                     line_color='purple', line_dash='dashed', line_width=0.5),
-                Label(text='GLO L3 CDMA', x=GLONASS_L3_OC_SC_FC,
-                      y=YMIN_LABEL, text_font_size='9px', text_align='center'),
-            ]
-            # GLONASS FDMA L1OF & L2OF Carriers
-            for carrier in range(-7, 9):
-                # L1OF
-                gloL1OFf0 = GLONASS_L1_OF_SF_FC + \
-                    (carrier * GLONASS_L1_OF_SF_SPACING)
-                freqAnnotationsGlonass.append(Span(
-                    location=gloL1OFf0, dimension='height', line_color='purple', line_dash='dashed', line_width=0.2))
-
-                # L2OF
-                gloL2OFf0 = GLONASS_L2_OF_SF_FC + \
-                    (carrier * GLONASS_L2_OF_SF_SPACING)
-                freqAnnotationsGlonass.append(Span(
-                    location=gloL2OFf0, dimension='height', line_color='purple', line_dash='dashed', line_width=0.2))
-
-            # GLONASS FDMA labels
-            freqAnnotationsGlonass.append(Label(text='GLO L1 FDMA', x=GLONASS_L1_OF_SF_FC,
-                                                y=YMIN_LABEL, text_font_size='9px', text_align='center', text_font_style='bold'))
-            freqAnnotationsGlonass.append(Label(text='GLO L2 FDMA', x=GLONASS_L2_OF_SF_FC,
-                                                y=YMIN_LABEL, text_font_size='9px', text_align='center', text_font_style='bold'))
-
-            self.spectrumFigures[block].renderers.extend(
-                freqAnnotationsGPS+freqAnnotationsGalileo+freqAnnotationsGlonass+freqAnnotationsQZSS+freqAnnotationsBeidou)
+            legendItems.extend([
+                (f"Block {block+1} PSD", [spectrum]),
+                (f"Block {block+1} Max PSD", [spectrumMax]),
+                (f"Block {block+1} Avg PSD", [spectrumAvg]),
+            ])
 
             # Selection Markers (Initially Hidden)
             self.selectionMarkers[block] = Span(
                 location=0, dimension='height', line_color='blue', line_dash='dotted', line_width=2, visible=False)
-            self.spectrumFigures[block].add_layout(
-                self.selectionMarkers[block])
+            self.spectrumFigure.add_layout(self.selectionMarkers[block])
 
             # Metadata label
-            self.blockMetadataLabels[block] = Div(text=f'No Data', width=PLOT_WIDTH, height=20)
-            self.selectionLabels[block] = Div(text='No Selection: ', height=20)
+            self.blockMetadataLabels[block] = Div(
+                text=f'Block {block+1}: No Data', width=PLOT_WIDTH, height=20)
+            self.selectionLabels[block] = Div(
+                text=f'Block {block+1}: No Selection', height=20)
 
-            # Create a column with rows for plot and metadata
-            self.blockColumnLayouts[block] = column(
-                row(children=[self.spectrumFigures[block]],
-                    sizing_mode="stretch_both"),
-                self.blockMetadataLabels[block],
-                self.selectionLabels[block]
-            )
+        # One legend covering every block's traces
+        legend = Legend(items=legendItems, location="center",
+                        click_policy="hide")
+        self.spectrumFigure.add_layout(legend, 'left')
 
         # Items to draw not specific to one block
         self.timeLabel = Div(text='No Time', height=20)
 
-        # Row layout of columns with plot and additional Metadata
+        # Column layout: the shared plot with the per-block metadata and
+        # selection rows beneath it
         self.doc.add_root(column(children=[
                                  row(children=[self.timeLabel],
                                      sizing_mode="stretch_width"),
-                                 row(children=self.blockColumnLayouts,
-                                     sizing_mode="stretch_both")
+                                 row(children=[self.spectrumFigure],
+                                     sizing_mode="stretch_both"),
+                                 row(children=self.blockMetadataLabels,
+                                     sizing_mode="stretch_width"),
+                                 row(children=self.selectionLabels,
+                                     sizing_mode="stretch_width")
                                  ], sizing_mode="stretch_both"))
 
         print(f"Reading from {inputBuffer}")
@@ -390,9 +444,9 @@ class UBXScope:
         if visible:
             data = self.selectionLabelData[block]
             # Assign to a text div
-            self.selectionLabels[block].text = f"Frequency: {data['frequency']} | PSD: {data['power']}dB | Max: {data['maxPower']}dB | Avg: {data['avgPower']}dB"
+            self.selectionLabels[block].text = f"Block {block+1}: Frequency: {data['frequency']} | PSD: {data['power']}dB | Max: {data['maxPower']}dB | Avg: {data['avgPower']}dB"
         else:
-            self.selectionLabels[block].text = f'No Selection'
+            self.selectionLabels[block].text = f'Block {block+1}: No Selection'
 
     def lineSelectCallback(self, attr, old, new, block):
         # This is received as a string representation of an array but numpy can parse it
@@ -424,29 +478,62 @@ class UBXScope:
     def avgVisibleChangeHandler(self, attr, old, new, block):
         # when set visible
         if new == True:
+            avgBuffer = self.spectrumAvgBuffers[block]
+            plotBuffers = self.spectrumPlotBuffers[block]
             # reset buffer indexes
-            self.spectrumAvgBuffers[block]['index'] = 0
-            self.spectrumAvgBuffers[block]['filled'] = 1
-            # Set first row of the buffer and the current displayed average to the current spectrum
-            self.spectrumAvgBuffers[block]['buffer'][self.spectrumAvgBuffers[block]
-                                                     ['index'], :] = self.spectrumDataSources[block].data['spectrum']
-            self.spectrumDataSources[block].data['spectrumAvg'] = self.spectrumDataSources[block].data['spectrum']
+            avgBuffer['index'] = 0
+            avgBuffer['filled'] = 1
+            # Clear the whole window first: the running sum subtracts each
+            # replaced row, so stale pre-reset rows would each bias it once
+            avgBuffer['buffer'].fill(0)
+            # Set first row of the buffer, the running sum, and the current
+            # displayed average to the current spectrum, all in place, then
+            # patch just the average column rather than replacing it
+            np.copyto(avgBuffer['buffer'][0, :], plotBuffers['spectrum'])
+            np.copyto(avgBuffer['sum'], plotBuffers['spectrum'])
+            np.copyto(plotBuffers['spectrumAvg'], plotBuffers['spectrum'])
+            self.spectrumDataSources[block].patch({
+                'spectrumAvg': [(slice(SPAN_BIN_COUNT), plotBuffers['spectrumAvg'])]})
 
     # Reset spectrum max when set visible
     def maxVisibleChangeHandler(self, attr, old, new, block):
         if new == True:
-            self.spectrumDataSources[block].data['spectrumMax'] = np.zeros(
-                SPAN_BIN_COUNT)
+            # Empty the peak-hold ring and zero the displayed trace in
+            # place, then patch just the max column; no replacement
+            # arrays are allocated
+            self.spectrumMaxBuffers[block]['buffer'].fill(-np.inf)
+            self.spectrumMaxBuffers[block]['index'] = 0
+            self.spectrumPlotBuffers[block]['spectrumMax'].fill(0)
+            self.spectrumDataSources[block].patch({
+                'spectrumMax': [(slice(SPAN_BIN_COUNT), self.spectrumPlotBuffers[block]['spectrumMax'])]})
+
+    # Runs as a next-tick callback under the document lock. All of the
+    # numeric work has already happened lock-free on the UBX reader
+    # thread, so the lock is held only for the model mutations below;
+    # bokeh.document.without_document_lock must not be applied here, as
+    # every statement in this callback touches document models
+    def updateSpectrumPlots(self):
+        # Allow the next SPAN message to queue another update
+        with self.spectrumUpdateLock:
+            self.spectrumUpdateScheduled = False
 
-    def updateSpectrumPlots(self, spectrumDataBlocks):
         # Update spectrum data
-        for block, spectrumData in enumerate(spectrumDataBlocks):
-            self.spectrumDataSources[block].data = spectrumData
+        # Patch the preallocated buffers into the data sources; only the
+        # columns that changed are serialised, and the static frequency
+        # axis is included on the first update alone
+        for block, plotBuffers in enumerate(self.spectrumPlotBuffers):
+            patch = self.spectrumPatchData[block]
+            if not self.spectrumFreqsSent[block]:
+                patch = dict(patch)
+                patch['spectrumBinCenterFreqs'] = [
+                    (slice(SPAN_BIN_COUNT), plotBuffers['spectrumBinCenterFreqs'])]
+                self.spectrumFreqsSent[block] = True
+            self.spectrumDataSources[block].patch(patch)
 
         # Spectrum metadata
         for index, blockMetadata in enumerate(self.spectrumMetadata):
             pgaGain = blockMetadata['pgaGain']
-            self.blockMetadataLabels[index].text = f'PGA Gain: {pgaGain}dB'
+            self.blockMetadataLabels[index].text = f'Block {index+1}: PGA Gain: {pgaGain}dB'
 
         # Update the selection marker text, if the marker is set
         for block in range(self.numRfBlocks):
@@ -471,53 +558,65 @@ class UBXScope:
 
         if msgClass == 'SPAN':
 
-            # Process new spectrum data
-            newSpectrumDataBlocks = [self.numRfBlocks, None]
+            # Process new spectrum data into the preallocated plot buffers
             for block in range(msg.numRfBlocks):
-                newSpectrumData = {}
+                plotBuffers = self.spectrumPlotBuffers[block]
 
                 # Centre Frequencies
-                newSpectrumData['spectrumBinCenterFreqs'] = msg.spectra[block]['spectrumBinCenterFreqs']
+                np.copyto(plotBuffers['spectrumBinCenterFreqs'],
+                          msg.spectra[block]['spectrumBinCenterFreqs'])
 
                 # PSD bin data
-                newSpectrumData['spectrum'] = msg.spectra[block]['spectrum']
-
-                # Calculate PSD max
-                newSpectrumData['spectrumMax'] = np.maximum(
-                    newSpectrumData['spectrum'], self.spectrumDataSources[block].data['spectrumMax'])
-
-                # Calculate Moving Average
-                # Replace row at index, to avoid push/pop. Order/wrapping doesn't matter unless weighting is applied
-                self.spectrumAvgBuffers[block]['buffer'][self.spectrumAvgBuffers[block]
-                                                         ['index'], :] = newSpectrumData['spectrum']
-
-                # calculate column-wise (time) mean of for all filled (non-zero) buffer rows
-                newSpectrumData['spectrumAvg'] = np.sum(
-                    self.spectrumAvgBuffers[block]['buffer'][0:self.spectrumAvgBuffers[block]['filled'], :], axis=0) / self.spectrumAvgBuffers[block]['filled']
+                np.copyto(plotBuffers['spectrum'],
+                          msg.spectra[block]['spectrum'])
+
+                # Feed the peak-hold and Moving Average buffers in one
+                # fused pass over the bins
+                # The buffer rows at index are replaced, to avoid
+                # push/pop. Order/wrapping doesn't matter unless weighting
+                # is applied
+                maxBuffer = self.spectrumMaxBuffers[block]
+                avgBuffer = self.spectrumAvgBuffers[block]
+                fuseSpectrumUpdate(plotBuffers['spectrum'],
+                                   maxBuffer['buffer'][maxBuffer['index'], :],
+                                   avgBuffer['buffer'][avgBuffer['index'], :],
+                                   avgBuffer['sum'],
+                                   plotBuffers['spectrumAvg'],
+                                   avgBuffer['filled'])
+
+                # Rolling peak hold: one vectorised max-reduce over the
+                # window (the whole ring fits in cache)
+                np.max(maxBuffer['buffer'], axis=0,
+                       out=plotBuffers['spectrumMax'])
 
                 #Write CSV
                 meta = ["spectrumAvg", str(block)]
-                line = meta + [str(round(w, 2)) for w in newSpectrumData['spectrumAvg']]
+                line = meta + [str(round(w, 2)) for w in plotBuffers['spectrumAvg']]
                 self.writer.writerow(line)
 
                 # Additional metadata for annotations
                 self.spectrumMetadata[block]['pgaGain'] = msg.spectra[block]['pga']
 
-                # Add spectrum for each block to one array to return, to assign to the data sources
-                newSpectrumDataBlocks[block] = newSpectrumData
-
-                # Increment indexes for moving average windows
-                self.spectrumAvgBuffers[block]['index'] = self.spectrumAvgBuffers[block]['index'] + 1
+                # Increment indexes for peak-hold and moving average windows
+                maxBuffer['index'] = maxBuffer['index'] + 1
+                avgBuffer['index'] = avgBuffer['index'] + 1
                 # Circular buffer wrap
-                if self.spectrumAvgBuffers[block]['index'] >= TIME_AVERAGING_WINDOW_LENGTH:
-                    self.spectrumAvgBuffers[block]['index'] = 0
+                if maxBuffer['index'] >= MAX_HOLD_WINDOW_LENGTH:
+                    maxBuffer['index'] = 0
+                if avgBuffer['index'] >= TIME_AVERAGING_WINDOW_LENGTH:
+                    avgBuffer['index'] = 0
 
                 # Increment buffer fullness till full
-                if (self.spectrumAvgBuffers[block]['filled'] < TIME_AVERAGING_WINDOW_LENGTH):
-                    self.spectrumAvgBuffers[block]['filled'] = self.spectrumAvgBuffers[block]['filled'] + 1
-
-            self.doc.add_next_tick_callback(
-                partial(self.updateSpectrumPlots, spectrumDataBlocks=newSpectrumDataBlocks))
+                if (avgBuffer['filled'] < TIME_AVERAGING_WINDOW_LENGTH):
+                    avgBuffer['filled'] = avgBuffer['filled'] + 1
+
+            # Schedule a plot update unless one is already pending; older
+            # frames are superseded by the buffer contents anyway
+            with self.spectrumUpdateLock:
+                scheduleUpdate = not self.spectrumUpdateScheduled
+                self.spectrumUpdateScheduled = True
+            if scheduleUpdate:
+                self.doc.add_next_tick_callback(self.updateSpectrumPlots)
 
         if msgClass == 'PVT':
             self.ubxMetadata['timeUTC'] = msg.UTC